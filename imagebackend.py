@@ -32,6 +32,7 @@ from nova import utils
 from nova.virt.disk import api as disk
 from nova.virt import images
 from nova.virt.libvirt import config as vconfig
+import qcow2_utils
 # from nova.virt.libvirt import rbd_utils
 import rbd_utils
 from nova.virt.libvirt import utils as libvirt_utils
@@ -80,6 +81,7 @@ CONF.import_opt('image_cache_subdirectory_name', 'nova.virt.imagecache')
 CONF.import_opt('preallocate_images', 'nova.virt.driver')
 CONF.import_opt('rbd_user', 'nova.virt.libvirt.volume', group='libvirt')
 CONF.import_opt('rbd_secret_uuid', 'nova.virt.libvirt.volume', group='libvirt')
+CONF.import_opt('resize_fs_using_block_device', 'nova.virt.disk.api')
 
 LOG = logging.getLogger(__name__)
 
@@ -237,7 +239,7 @@ class Image(object):
             raise exception.FlavorDiskTooSmall()
 
     def get_disk_size(self, name):
-        disk.get_disk_size(name)
+        return disk.get_disk_size(name)
 
     def snapshot_extract(self, target, out_format):
         raise NotImplementedError()
@@ -307,14 +309,104 @@ class Image(object):
         '''
         return False
 
-    def direct_fetch(self, image_id, image_meta, image_locations):
+    def direct_fetch(self, image_id, image_meta, image_locations, size=None):
         """Create an image from a direct image location.
 
+        :size: Size the image will be resized to in bytes (optional)
         :raises: exception.ImageUnacceptable if it cannot be fetched directly
         """
         reason = _('direct_fetch() is not implemented')
         raise exception.ImageUnacceptable(image_id=image_id, reason=reason)
 
+
+class Qcow2(Image):
+    # base path -> ((st_mtime, st_size), virtual size in bytes)
+    _disk_sizes = {}
+
+    def __init__(self, instance=None, disk_name=None, path=None):
+        super(Qcow2, self).__init__("file", "qcow2", is_block_dev=False)
+
+        self.path = (path or
+                     os.path.join(libvirt_utils.get_instance_path(instance),
+                                  disk_name))
+        self.preallocate = CONF.preallocate_images != 'none'
+        self.disk_info_path = os.path.join(os.path.dirname(self.path),
+                                           'disk.info')
+        self.resolve_driver_format()
+
+    def get_disk_size(self, name):
+        """Returns the virtual size of the disk image name in bytes.
+
+        Raw and qcow2 images are sized from their headers, anything else
+        through qemu-img. The result is remembered until the file changes,
+        which also makes repeated verify_base_size() calls on a base cheap.
+        """
+        st = os.stat(name)
+        key = (st.st_mtime, st.st_size)
+        cached = self._disk_sizes.get(name)
+        if cached and cached[0] == key:
+            return cached[1]
+        size = qcow2_utils.get_virtual_size(name)
+        if size is None:
+            size = disk.get_disk_size(name)
+        self._disk_sizes[name] = (key, size)
+        return size
+
+    def create_image(self, prepare_template, base, size, *args, **kwargs):
+        @utils.synchronized(base, external=True, lock_path=self.lock_path)
+        def copy_qcow2_image(base, target, size):
+            # NOTE: disk.extend() can grow the guest filesystem of a cow
+            # image only through a block device, so keep qemu-img when
+            # that is enabled or when the base has a format we can't size.
+            base_format = qcow2_utils.get_format(base)
+            if base_format is None or CONF.resize_fs_using_block_device:
+                libvirt_utils.create_cow_image(base, target)
+                if size:
+                    disk.extend(target, size, use_cow=True)
+                return
+            virtual_size = max(size or 0, self.get_disk_size(base))
+            qcow2_utils.create_overlay(target, base, base_format,
+                                       virtual_size)
+
+        # Download the unmodified base image unless we already have a copy.
+        if not os.path.exists(base):
+            prepare_template(target=base, max_size=size, *args, **kwargs)
+        else:
+            self.verify_base_size(base, size)
+
+        legacy_backing_size = None
+        legacy_base = base
+
+        # Determine whether an existing qcow2 disk uses a legacy backing by
+        # looking at the backing file recorded in the image itself.
+        if os.path.exists(self.path):
+            backing_path = qcow2_utils.get_backing_file(self.path)
+            if backing_path is not None:
+                backing_file = os.path.basename(backing_path)
+                backing_parts = backing_file.rpartition('_')
+                if backing_file != backing_parts[-1] and \
+                        backing_parts[-1].isdigit():
+                    legacy_backing_size = int(backing_parts[-1])
+                    legacy_base += '_%d' % legacy_backing_size
+                    legacy_backing_size *= units.Gi
+
+        # Create the legacy backing file if necessary.
+        if legacy_backing_size:
+            if not os.path.exists(legacy_base):
+                with fileutils.remove_path_on_error(legacy_base):
+                    libvirt_utils.copy_image(base, legacy_base)
+                    disk.extend(legacy_base, legacy_backing_size, use_cow=True)
+
+        if not os.path.exists(self.path):
+            with fileutils.remove_path_on_error(self.path):
+                copy_qcow2_image(base, self.path, size)
+
+    def snapshot_extract(self, target, out_format):
+        libvirt_utils.extract_snapshot(self.path, 'qcow2',
+                                       target,
+                                       out_format)
+
+
 class Rbd(Image):
     def __init__(self, instance=None, disk_name=None, path=None, **kwargs):
         super(Rbd, self).__init__("block", "rbd", is_block_dev=True)
@@ -325,27 +417,21 @@ class Rbd(Image):
                 raise exception.InvalidDevicePath(path=path)
         else:
             self.rbd_name = '%s_%s' % (instance, disk_name)
-        
 
 
         if not CONF.libvirt.images_rbd_pool:
             raise RuntimeError(_('You should specify'
                                  ' images_rbd_pool'
                                  ' flag to use rbd images.'))
-        # CONF.libvirt.rbd_secret_uuid
-        CONF.libvirt.images_rbd_pool = 'vm-images'
-        CONF.libvirt.rbd_user = 'compute01'
-        CONF.libvirt.images_rbd_ceph_conf='/etc/ceph/ceph.conf'
-        
+
         self.pool = CONF.libvirt.images_rbd_pool
         self.rbd_user = CONF.libvirt.rbd_user
         self.ceph_conf = CONF.libvirt.images_rbd_ceph_conf
-        
+
         print("Rbd pool:%s" % self.pool)
         print("Rbd user:%s" % self.rbd_user)
 
-
-        self.driver = rbd_utils.RBDDriver(
+        self.driver = rbd_utils.get_driver(
             pool=self.pool,
             ceph_conf=self.ceph_conf,
             rbd_user=self.rbd_user,
@@ -416,13 +502,13 @@ class Rbd(Image):
         # prepare_template() may have cloned the image into a new rbd
         # image already instead of downloading it locally
         if not self.check_image_exists():
-            # keep using the command line import instead of librbd since it
-            # detects zeroes to preserve sparseness in the image
-            args = ['--pool', self.pool, base, self.rbd_name]
-            if self.driver.supports_layering():
-                args += ['--new-format']
-                args += self.driver.ceph_args()
-                utils.execute('rbd', 'import', *args)
+            if (CONF.libvirt.rbd_dedup_base_images and
+                    self.driver.supports_layering() and
+                    self.driver.supports_content_index()):
+                self.driver.import_image_dedup(base, self.rbd_name,
+                                               size=size)
+            else:
+                self.driver.import_image(base, self.rbd_name)
 
         if size and size > self.get_disk_size(self.rbd_name):
             self.driver.resize(self.rbd_name, size)
@@ -434,7 +520,7 @@ class Rbd(Image):
     def is_shared_block_storage():
         return True
 
-    def direct_fetch(self, image_id, image_meta, image_locations):
+    def direct_fetch(self, image_id, image_meta, image_locations, size=None):
         if self.check_image_exists():
             return
         if image_meta.get('disk_format') not in ['raw', 'iso']:
@@ -445,8 +531,14 @@ class Rbd(Image):
             raise exception.ImageUnacceptable(image_id=image_id, reason=reason)
 
         for location in image_locations:
-            if self.driver.is_cloneable(location, image_meta):
-                return self.driver.clone(location, self.rbd_name)
+            try:
+                cloneable = self.driver.is_cloneable(location, image_meta)
+            except rbd_utils.RBDOperationTimeout as e:
+                LOG.warn(_('Skipping image location %(url)s: %(err)s'),
+                         {'url': location.get('url'), 'err': e})
+                continue
+            if cloneable:
+                return self.driver.clone(location, self.rbd_name, size=size)
 
         reason = _('No image locations are accessible')
         raise exception.ImageUnacceptable(image_id=image_id, reason=reason)
@@ -491,6 +583,10 @@ class Backend(object):
         return backend(path=disk_path)
 
 def main():
+    CONF.set_override('images_rbd_pool', 'vm-images', group='libvirt')
+    CONF.set_override('rbd_user', 'compute01', group='libvirt')
+    CONF.set_override('images_rbd_ceph_conf', '/etc/ceph/ceph.conf',
+                      group='libvirt')
     print(CONF.libvirt.images_type)
     
     # rbd image exists 
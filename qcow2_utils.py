@@ -0,0 +1,161 @@
+# Copyright 2012 Grid Dynamics
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Just enough of the qcow2 format to create copy-on-write overlays and
+read virtual sizes without running qemu-img.
+"""
+
+import os
+import struct
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+QCOW_MAGIC = 'QFI\xfb'
+QCOW2_VERSION = 2
+
+# magic, version, backing_file_offset, backing_file_size, cluster_bits,
+# size, crypt_method, l1_size, l1_table_offset, refcount_table_offset,
+# refcount_table_clusters, nb_snapshots, snapshots_offset
+_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+_HEADER_EXT = struct.Struct('>II')
+_BACKING_FORMAT_EXT = 0xE2792ACA
+
+_CLUSTER_BITS = 16
+_CLUSTER_SIZE = 1 << _CLUSTER_BITS
+# refcount_order 4 (16 bit refcounts) is the only one qcow2 v2 supports
+_REFCOUNT_SIZE = 2
+
+# NOTE: signatures of the other formats qemu probes for, checked with
+# the vdi and dmg ones below. Only a file carrying none of them is
+# treated as raw; everything else is left to qemu-img.
+_OTHER_MAGICS = ['QED\x00', 'KDMV', 'COWD', '# Disk DescriptorFile',
+                 'conectix', 'vhdxfile',
+                 'LUKS\xba\xbe',
+                 'WithoutFreeSpace', 'WithouFreSpacExt',
+                 'Bochs Virtual HD Image',
+                 '#!/bin/sh\n#V2.0 Format\nmodprobe cloop']
+_VDI_MAGIC_OFFSET = 0x40
+_VDI_MAGIC = struct.pack('<I', 0xbeda107f)
+# dmg has no header, only a 512 byte 'koly' trailer at the end of the file
+_DMG_TRAILER_SIZE = 512
+_DMG_MAGIC = 'koly'
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        return f.read(512)
+
+
+def get_format(path):
+    """Return 'qcow2' or 'raw' for path, or None for any other format."""
+    data = _read_header(path)
+    if data.startswith(QCOW_MAGIC):
+        version = struct.unpack('>I', data[4:8])[0]
+        return 'qcow2' if version in (2, 3) else None
+    if any(data.startswith(magic) for magic in _OTHER_MAGICS):
+        return None
+    if (data[_VDI_MAGIC_OFFSET:_VDI_MAGIC_OFFSET + 4] == _VDI_MAGIC):
+        return None
+    if _has_dmg_trailer(path):
+        return None
+    return 'raw'
+
+
+def _has_dmg_trailer(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < _DMG_TRAILER_SIZE:
+            return False
+        f.seek(-_DMG_TRAILER_SIZE, os.SEEK_END)
+        return f.read(len(_DMG_MAGIC)) == _DMG_MAGIC
+
+
+def get_virtual_size(path):
+    """Return the virtual size of a raw or qcow2 image in bytes.
+
+    Returns None when the image is in some other format.
+    """
+    fmt = get_format(path)
+    if fmt == 'raw':
+        return os.path.getsize(path)
+    if fmt == 'qcow2':
+        return _HEADER.unpack(_read_header(path)[:_HEADER.size])[5]
+    return None
+
+
+def get_backing_file(path):
+    """Return the backing file recorded in a qcow2 image, if any."""
+    if get_format(path) != 'qcow2':
+        return None
+    header = _HEADER.unpack(_read_header(path)[:_HEADER.size])
+    offset, length = header[2], header[3]
+    if not offset:
+        return None
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _round_up(value, boundary):
+    return (value + boundary - 1) // boundary * boundary
+
+
+def create_overlay(path, backing_file, backing_format, size):
+    """Write a qcow2 (v2) image of size bytes backed by backing_file.
+
+    This produces the same layout qemu-img create uses for an empty
+    overlay: the header cluster, a one cluster refcount table, a refcount
+    block and the L1 table, with every guest cluster unallocated so reads
+    fall through to the backing file.
+    """
+    l2_entries = _CLUSTER_SIZE // 8
+    l1_size = max(1, -(-size // (_CLUSTER_SIZE * l2_entries)))
+    l1_clusters = _round_up(l1_size * 8, _CLUSTER_SIZE) // _CLUSTER_SIZE
+
+    refcount_table_offset = _CLUSTER_SIZE
+    refcount_block_offset = 2 * _CLUSTER_SIZE
+    l1_table_offset = 3 * _CLUSTER_SIZE
+    total_clusters = 3 + l1_clusters
+
+    extensions = ''
+    if backing_format:
+        fmt = backing_format.encode('utf-8')
+        extensions += _HEADER_EXT.pack(_BACKING_FORMAT_EXT, len(fmt))
+        extensions += fmt + '\0' * (_round_up(len(fmt), 8) - len(fmt))
+    extensions += _HEADER_EXT.pack(0, 0)
+
+    backing_file = backing_file.encode('utf-8')
+    backing_file_offset = _HEADER.size + len(extensions)
+    if backing_file_offset + len(backing_file) > _CLUSTER_SIZE:
+        raise ValueError('backing file name too long: %s' % backing_file)
+
+    header = _HEADER.pack(QCOW_MAGIC, QCOW2_VERSION,
+                          backing_file_offset, len(backing_file),
+                          _CLUSTER_BITS, size, 0,
+                          l1_size, l1_table_offset,
+                          refcount_table_offset, 1, 0, 0)
+    refcounts = struct.pack('>%dH' % total_clusters, *([1] * total_clusters))
+
+    LOG.debug('creating qcow2 overlay %(path)s backed by %(base)s',
+              {'path': path, 'base': backing_file})
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    with os.fdopen(fd, 'wb') as f:
+        # the L1 table stays all zeroes, so leave it as a hole
+        f.truncate(total_clusters * _CLUSTER_SIZE)
+        f.write(header + extensions + backing_file)
+        f.seek(refcount_table_offset)
+        f.write(struct.pack('>Q', refcount_block_offset))
+        f.seek(refcount_block_offset)
+        f.write(refcounts)
@@ -11,15 +11,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import functools
+import hashlib
+import os
+import threading
+import time
 import urllib
 import sys, traceback
 
-try:
-    import rados
-    import rbd
-except ImportError:
-    rados = None
-    rbd = None
+from eventlet import tpool
+from oslo.config import cfg
+import six
+from six.moves import queue
 
 from nova import exception
 from nova.openstack.common import excutils
@@ -27,10 +32,813 @@ from nova.openstack.common.gettextutils import _
 from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common import units
+from nova.openstack.common import uuidutils
 from nova import utils
 
+rbd_opts = [
+    cfg.IntOpt('rbd_pool_concurrency',
+               default=32,
+               help='Maximum number of rbd operations running at the same '
+                    'time against a single RADOS pool. 0 => unlimited'),
+    cfg.DictOpt('rbd_op_class_concurrency',
+                default={'import': '4', 'clone': '16', 'resize': '16',
+                         'delete': '4', 'metadata': '32'},
+                help='Maximum number of concurrent rbd operations per pool '
+                     'for each operation class (metadata, clone, import, '
+                     'resize, delete). Missing or 0 => unlimited'),
+    cfg.IntOpt('rbd_max_queued_ops',
+               default=256,
+               help='Maximum number of rbd operations of one operation '
+                    'class waiting for admission on a single pool before '
+                    'new ones of that class are rejected. 0 => unlimited'),
+    cfg.FloatOpt('rbd_metadata_op_timeout',
+                 default=0,
+                 help='Deadline in seconds for read-only rbd metadata calls '
+                      '(exists, size, is_cloneable, get_mon_addrs, '
+                      'get_pool_info). 0 => no deadline'),
+    cfg.BoolOpt('rbd_hedge_metadata_ops',
+                default=False,
+                help='Issue a second attempt of a read-only rbd metadata '
+                     'call when the first one is slower than '
+                     'rbd_hedge_percentile of recent calls, and use '
+                     'whichever returns first'),
+    cfg.IntOpt('rbd_hedge_percentile',
+               default=95,
+               help='Latency percentile of recent calls after which a '
+                    'metadata call is hedged'),
+    cfg.IntOpt('rbd_hedge_min_samples',
+               default=20,
+               help='Number of latency samples an operation needs before '
+                    'it is hedged'),
+    cfg.IntOpt('rbd_metadata_max_inflight',
+               default=10,
+               help='Maximum number of guarded rbd metadata attempts, '
+                    'including ones abandoned after their deadline, that '
+                    'may run at the same time per driver. Each holds an '
+                    'eventlet tpool worker while blocked in librados. '
+                    '0 => unlimited'),
+    cfg.IntOpt('rbd_rados_op_timeout',
+               default=60,
+               help='Seconds after which librados gives up on an OSD or '
+                    'monitor operation of the shared client, so that calls '
+                    'abandoned by rbd_metadata_op_timeout eventually '
+                    'return. 0 => wait forever'),
+    cfg.BoolOpt('rbd_dedup_base_images',
+                default=False,
+                help='Store each distinct base image content once in the '
+                     'pool and clone instance disks from it instead of '
+                     'importing every base separately. Requires layering '
+                     'and python-rados omap support; otherwise bases are '
+                     'imported as usual'),
+    cfg.IntOpt('rbd_warm_pool_size',
+               default=0,
+               help='Number of pre-cloned, pre-resized spare rbd images to '
+                    'keep for each popular image and disk size. '
+                    '0 => warm pool disabled'),
+    cfg.IntOpt('rbd_warm_pool_max_spares',
+               default=64,
+               help='Maximum number of spare rbd images this host keeps in '
+                    'total. 0 => unlimited'),
+    cfg.IntOpt('rbd_warm_pool_min_hits',
+               default=3,
+               help='Number of times an image and disk size must be '
+                    'requested within rbd_warm_pool_ttl before spares are '
+                    'kept for it'),
+    cfg.IntOpt('rbd_warm_pool_ttl',
+               default=3600,
+               help='Seconds after which unused spare rbd images are '
+                    'removed and request counts are forgotten. Spares are '
+                    'clones of the glance image snapshot, so while any '
+                    'host keeps one, deleting that image in glance fails '
+                    'with the snapshot still in use; spares of a snapshot '
+                    'that is removed or unprotected are dropped at once'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(rbd_opts, 'libvirt')
+CONF.import_opt('host', 'nova.netconf')
+
 LOG = logging.getLogger(__name__)
 
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 50
+PRIORITY_BULK = 100
+
+# NOTE: operations on the spawn path win over bulk cleanup when a pool
+# is saturated.
+OP_PRIORITIES = {
+    'metadata': PRIORITY_INTERACTIVE,
+    'clone': PRIORITY_INTERACTIVE,
+    'import': PRIORITY_NORMAL,
+    'resize': PRIORITY_INTERACTIVE,
+    'delete': PRIORITY_BULK,
+    'flatten': PRIORITY_BULK,
+}
+
+# NOTE: rados and rbd are loaded on first use by _load_rbd_libs() so that
+# importing this module does not pull in librados/librbd.
+rados = None
+rbd = None
+_rbd_libs_loaded = False
+
+_drivers = {}
+_drivers_lock = threading.Lock()
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+# NOTE: omap object mapping the sha256 of a base image's content to the
+# 'image@snapshot' in the same pool that holds it.
+CONTENT_INDEX_OBJECT = 'nova_content_index'
+CONTENT_IMAGE_PREFIX = 'base_'
+CONTENT_SNAPSHOT = 'base'
+
+# path -> ((st_mtime, st_size), hex digest)
+_file_digests = {}
+
+
+def _load_rbd_libs():
+    global rados, rbd, _rbd_libs_loaded
+    if not _rbd_libs_loaded:
+        try:
+            rados = __import__('rados')
+            rbd = __import__('rbd')
+        except ImportError:
+            rados = None
+            rbd = None
+        _rbd_libs_loaded = True
+    return rbd, rados
+
+
+def get_driver(pool, ceph_conf, rbd_user, rbd_lib=None, rados_lib=None):
+    """Return the process-wide RBDDriver for (pool, ceph_conf, rbd_user).
+
+    All callers asking for the same pool, ceph configuration file and user
+    share a single driver along with its cached cluster state. Passing
+    explicit rbd/rados libraries bypasses the registry and returns a
+    private driver.
+    """
+    if rbd_lib or rados_lib:
+        return RBDDriver(pool, ceph_conf, rbd_user,
+                         rbd_lib=rbd_lib, rados_lib=rados_lib)
+    key = (pool, ceph_conf or '', rbd_user)
+    driver = _drivers.get(key)
+    if driver is None:
+        with _drivers_lock:
+            driver = _drivers.get(key)
+            if driver is None:
+                driver = RBDDriver(pool, ceph_conf, rbd_user)
+                _drivers[key] = driver
+    return driver
+
+
+def file_digest(path, chunk_size=units.Mi):
+    """Return the sha256 hex digest of a file's content.
+
+    The file is read once in chunks; the digest is remembered until the
+    file changes on disk.
+    """
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+    cached = _file_digests.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _file_digests[path] = (key, digest)
+    return digest
+
+
+class RBDOperationRejected(exception.NovaException):
+    msg_fmt = _("Too many queued rbd %(op_class)s operations on pool "
+                "%(pool)s, rejecting new requests")
+
+
+class OperationScheduler(object):
+    """Admission control for rbd operations.
+
+    Every driver operation enters through schedule(), which blocks until
+    both the per-pool limit and the per-operation-class limit of the target
+    pool have room. A request that fits is admitted at once unless a waiter
+    of the same or higher priority could take the slot; waiters held back
+    only by their own class limit do not block other classes. Waiters are
+    admitted in priority order (lowest value first, FIFO within a
+    priority). When the wait queue of an operation class on a pool is full
+    new requests of that class are rejected with RBDOperationRejected so
+    callers back off instead of piling up. A limit of 0 means unlimited.
+    """
+    def __init__(self, pool_limit=0, class_limits=None, max_queued=0):
+        self.pool_limit = pool_limit
+        self.class_limits = dict(class_limits or {})
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._running = {}
+        self._class_running = {}
+        self._waiters = {}
+        self._seq = 0
+        self._stats = {}
+
+    def _limit_reached(self, pool, op_class):
+        if self.pool_limit and self._running.get(pool, 0) >= self.pool_limit:
+            return True
+        class_limit = self.class_limits.get(op_class, 0)
+        return bool(class_limit and
+                    self._class_running.get((pool, op_class), 0) >=
+                    class_limit)
+
+    def _may_start(self, pool, op_class, priority):
+        if self._limit_reached(pool, op_class):
+            return False
+        return not any(waiter[0] <= priority and
+                       not self._limit_reached(pool, waiter[2])
+                       for waiter in self._waiters.get(pool, ()))
+
+    def _is_next(self, pool, ticket):
+        # the first waiter in priority order that fits within the limits
+        # goes next, so a full class does not block the other classes
+        for waiter in sorted(self._waiters[pool]):
+            if not self._limit_reached(pool, waiter[2]):
+                return waiter == ticket
+        return False
+
+    def _record(self, pool, op_class, key, value=None):
+        stats = self._stats.setdefault((pool, op_class), {
+            'count': 0, 'rejected': 0,
+            'queue_time': 0.0, 'queue_time_max': 0.0,
+            'exec_time': 0.0, 'exec_time_max': 0.0})
+        if value is None:
+            stats[key] += 1
+        else:
+            stats[key] += value
+            stats[key + '_max'] = max(stats[key + '_max'], value)
+
+    def acquire(self, pool, op_class, priority=None):
+        """Block until the operation is admitted and return its token.
+
+        The token has to be handed back to release() once the operation
+        has really finished.
+        """
+        if priority is None:
+            priority = OP_PRIORITIES.get(op_class, PRIORITY_NORMAL)
+        queued_at = time.time()
+        with self._cond:
+            waiters = self._waiters.setdefault(pool, [])
+            if not self._may_start(pool, op_class, priority):
+                queued = sum(1 for waiter in waiters
+                             if waiter[2] == op_class)
+                if self.max_queued and queued >= self.max_queued:
+                    self._record(pool, op_class, 'rejected')
+                    raise RBDOperationRejected(pool=pool, op_class=op_class)
+                self._seq += 1
+                ticket = (priority, self._seq, op_class)
+                waiters.append(ticket)
+                try:
+                    while not self._is_next(pool, ticket):
+                        self._cond.wait()
+                finally:
+                    waiters.remove(ticket)
+                    # admitting one waiter may leave room for the next
+                    self._cond.notify_all()
+            return self._start(pool, op_class, queued_at)
+
+    def try_acquire(self, pool, op_class):
+        """Admit the operation only if nothing waits for the pool.
+
+        Returns a token for release(), or None without queueing.
+        """
+        with self._cond:
+            if (self._waiters.get(pool) or
+                    self._limit_reached(pool, op_class)):
+                return None
+            return self._start(pool, op_class, time.time())
+
+    def _start(self, pool, op_class, queued_at):
+        self._running[pool] = self._running.get(pool, 0) + 1
+        self._class_running[(pool, op_class)] = (
+            self._class_running.get((pool, op_class), 0) + 1)
+        started_at = time.time()
+        self._record(pool, op_class, 'count')
+        self._record(pool, op_class, 'queue_time', started_at - queued_at)
+        return pool, op_class, started_at
+
+    def release(self, token):
+        pool, op_class, started_at = token
+        with self._cond:
+            self._running[pool] -= 1
+            self._class_running[(pool, op_class)] -= 1
+            self._record(pool, op_class, 'exec_time',
+                         time.time() - started_at)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def schedule(self, pool, op_class, priority=None):
+        token = self.acquire(pool, op_class, priority=priority)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def get_stats(self):
+        """Return a snapshot of queue and execution time per operation.
+
+        The result maps (pool, op_class) to a dict with the number of
+        admitted and rejected operations and the total and maximum time
+        in seconds spent queued and executing.
+        """
+        with self._cond:
+            return dict((key, dict(value))
+                        for key, value in self._stats.items())
+
+
+def get_scheduler():
+    """Return the process-wide OperationScheduler built from CONF."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                class_limits = dict(
+                    (op_class, int(limit)) for op_class, limit in
+                    CONF.libvirt.rbd_op_class_concurrency.items())
+                _scheduler = OperationScheduler(
+                    pool_limit=CONF.libvirt.rbd_pool_concurrency,
+                    class_limits=class_limits,
+                    max_queued=CONF.libvirt.rbd_max_queued_ops)
+    return _scheduler
+
+
+class RBDOperationTimeout(exception.NovaException):
+    msg_fmt = _("rbd %(op_name)s did not complete within %(timeout)s "
+                "seconds")
+
+
+class RBDOperationBacklogged(RBDOperationTimeout):
+    msg_fmt = _("Too many earlier rbd %(op_name)s calls are still running, "
+                "not starting another")
+
+
+class LatencyGuard(object):
+    """Deadlines and hedging for read-only rbd metadata calls.
+
+    With a timeout set, call() gives up waiting after that many seconds and
+    raises RBDOperationTimeout; the attempt itself cannot be interrupted and
+    finishes in the background. With hedging enabled, once an operation has
+    enough latency samples, an attempt still running past the configured
+    percentile of recent latencies gets a second attempt issued next to it,
+    and whichever finishes first supplies the result.
+
+    Every attempt holds its own scheduler slot until it really finishes, so
+    abandoned attempts keep counting against the pool limits. At most
+    max_inflight attempts run at once: beyond that no hedge is issued and
+    new calls fail with RBDOperationBacklogged. Attempts run in green
+    threads; the driver sends the blocking librados calls inside them to
+    eventlet.tpool, and the shared client's rados_osd_op_timeout bounds how
+    long an abandoned attempt can hold a tpool worker.
+
+    Only idempotent calls may be guarded, since a losing attempt keeps
+    running to completion.
+    """
+    def __init__(self, timeout=0, hedge=False, hedge_percentile=95,
+                 hedge_min_samples=20, window=200, max_inflight=0):
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.window = window
+        self.max_inflight = max_inflight
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._stats = {}
+        self._inflight = 0
+
+    def _record(self, op_name, key):
+        with self._lock:
+            stats = self._stats.setdefault(op_name, {
+                'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'timeouts': 0,
+                'backlogged': 0})
+            stats[key] += 1
+
+    def _record_latency(self, op_name, latency):
+        with self._lock:
+            samples = self._latencies.setdefault(
+                op_name, collections.deque(maxlen=self.window))
+            samples.append(latency)
+
+    def _hedge_threshold(self, op_name):
+        with self._lock:
+            samples = sorted(self._latencies.get(op_name, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        index = int(len(samples) * self.hedge_percentile / 100.0)
+        return samples[min(index, len(samples) - 1)]
+
+    def _reserve(self):
+        with self._lock:
+            if self.max_inflight and self._inflight >= self.max_inflight:
+                return False
+            self._inflight += 1
+            return True
+
+    def _spawn(self, op_name, attempt, results, func, args, kwargs,
+               release):
+        def run():
+            started_at = time.time()
+            try:
+                outcome = (True, func(*args, **kwargs), attempt)
+            except Exception:
+                outcome = (False, sys.exc_info(), attempt)
+            finally:
+                with self._lock:
+                    self._inflight -= 1
+                release()
+            self._record_latency(op_name, time.time() - started_at)
+            results.put(outcome)
+
+        worker = threading.Thread(target=run)
+        worker.daemon = True
+        worker.start()
+
+    def _wait(self, op_name, results, deadline):
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+        try:
+            return results.get(timeout=remaining)
+        except queue.Empty:
+            self._record(op_name, 'timeouts')
+            raise RBDOperationTimeout(op_name=op_name, timeout=self.timeout)
+
+    def call(self, op_name, func, args=(), kwargs=None,
+             acquire=None, try_acquire=None, release=None):
+        """Run func(*args, **kwargs) under the deadline and hedging policy.
+
+        :acquire: blocks until the first attempt may start and returns a
+                  token for release
+        :try_acquire: returns a token for a hedge attempt, or None if the
+                      hedge must not be issued now
+        :release: called with the token once an attempt has finished
+        """
+        kwargs = kwargs or {}
+        acquire = acquire or (lambda: None)
+        try_acquire = try_acquire or (lambda: None)
+        release = release or (lambda token: None)
+
+        if not self.timeout and not self.hedge:
+            token = acquire()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                release(token)
+
+        self._record(op_name, 'calls')
+        if not self._reserve():
+            self._record(op_name, 'backlogged')
+            raise RBDOperationBacklogged(op_name=op_name)
+        try:
+            token = acquire()
+        except Exception:
+            with self._lock:
+                self._inflight -= 1
+            raise
+        deadline = time.time() + self.timeout if self.timeout else None
+        results = queue.Queue()
+        self._spawn(op_name, 1, results, func, args, kwargs,
+                    functools.partial(release, token))
+
+        threshold = self._hedge_threshold(op_name) if self.hedge else None
+        if threshold is not None and deadline is not None:
+            threshold = min(threshold, max(deadline - time.time(), 0))
+        if threshold is not None:
+            try:
+                outcome = results.get(timeout=threshold)
+            except queue.Empty:
+                if ((deadline is None or time.time() < deadline) and
+                        self._hedge(op_name, results, func, args, kwargs,
+                                    try_acquire, release)):
+                    LOG.debug('rbd %(op)s slower than %(threshold).3fs, '
+                              'hedged', {'op': op_name,
+                                         'threshold': threshold})
+                outcome = self._wait(op_name, results, deadline)
+        else:
+            outcome = self._wait(op_name, results, deadline)
+
+        succeeded, value, attempt = outcome
+        if attempt > 1:
+            self._record(op_name, 'hedge_wins')
+        if not succeeded:
+            six.reraise(*value)
+        return value
+
+    def _hedge(self, op_name, results, func, args, kwargs, try_acquire,
+               release):
+        if not self._reserve():
+            return False
+        token = try_acquire()
+        if token is None:
+            with self._lock:
+                self._inflight -= 1
+            return False
+        self._record(op_name, 'hedged')
+        self._spawn(op_name, 2, results, func, args, kwargs,
+                    functools.partial(release, token))
+        return True
+
+    def get_stats(self):
+        """Return per-operation call, hedge, hedge win, timeout and
+        backlog counts.
+        """
+        with self._lock:
+            return dict((key, dict(value))
+                        for key, value in self._stats.items())
+
+
+def _guarded(func):
+    """Run a read-only RBDDriver method as a guarded metadata operation.
+
+    Each attempt is admitted by the scheduler and holds its slot until it
+    finishes, even after the caller has given up on it; latency samples
+    exclude the time spent queued. A hedge is only issued if the pool has
+    room and nothing is waiting for it.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        pool = kwargs.get('pool') or self.pool
+        return self.latency_guard.call(
+            func.__name__, func, (self,) + args, kwargs,
+            acquire=functools.partial(self.scheduler.acquire, pool,
+                                      'metadata'),
+            try_acquire=functools.partial(self.scheduler.try_acquire, pool,
+                                          'metadata'),
+            release=self.scheduler.release)
+    return wrapper
+
+
+class WarmPool(object):
+    """Spare clones of popular parents, ready to be renamed into place.
+
+    Every clone request records a hit for its (parent, size), where parent
+    is a (pool, image, snapshot) tuple and size is the disk size in bytes
+    (0 keeps the parent's size). Once a (parent, size) has been requested
+    min_hits times within ttl seconds, a background refill keeps up to
+    spares_per_image clones of it, already grown to size, named
+    SPARE_PREFIX + '<host>.<created>.<size>.<id>'. take() then provisions
+    a disk with a single rename.
+
+    Each compute host only manages its own spares in the shared pool:
+    reconcile() picks up the ones carrying this host's name when the warm
+    pool starts. Spares older than ttl are removed by the background
+    refill, never on the spawn path, and take() falls back to a normal
+    clone whenever a spare can't be used.
+
+    Spares are clone children of the parent snapshot, so as long as any
+    host holds one the snapshot can't be unprotected and glance can't
+    delete the image. The refill drops all spares and hits of a parent
+    as soon as its snapshot can't be opened or is no longer protected;
+    otherwise they only go away with the ttl.
+    """
+    SPARE_PREFIX = 'spare.'
+
+    def __init__(self, driver, host, spares_per_image, max_spares=0,
+                 min_hits=1, ttl=3600):
+        self.driver = driver
+        self.host = host
+        self.spares_per_image = spares_per_image
+        self.max_spares = max_spares
+        self.min_hits = min_hits
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (parent, size) -> list of (created_at, spare name)
+        self._spares = {}
+        # (parent, size) -> deque of hit times
+        self._hits = {}
+        # spares found expired by take(), removed by the next refill
+        self._expired = []
+        self._refilling = False
+
+    def start(self):
+        """Reconcile with the pool, then refill, in the background."""
+        with self._lock:
+            self._refilling = True
+        self._spawn(self._run, True)
+
+    def _spawn(self, func, *args):
+        worker = threading.Thread(target=func, args=args)
+        worker.daemon = True
+        worker.start()
+
+    def _spare_name(self, size):
+        return '%s%s.%d.%d.%s' % (self.SPARE_PREFIX, self.host,
+                                  int(time.time()), size,
+                                  uuidutils.generate_uuid()[:8])
+
+    def _parse_spare_name(self, name):
+        """Return (created_at, size) of one of this host's spares, or None.
+
+        Host names may contain dots, so the fields are split off the end.
+        """
+        try:
+            host, created_at, size, _uuid = (
+                name[len(self.SPARE_PREFIX):].rsplit('.', 3))
+            if host != self.host:
+                return None
+            return int(created_at), int(size)
+        except ValueError:
+            return None
+
+    def _remove_spare(self, name):
+        try:
+            self.driver.remove(name)
+        except self.driver.rbd.ImageNotFound:
+            pass
+        except (self.driver.rbd.Error, RBDOperationRejected) as e:
+            LOG.warn(_('Unable to remove spare rbd image %(name)s: %(err)s'),
+                     {'name': name, 'err': e})
+
+    def reconcile(self):
+        """Rebuild the spare inventory from the images in the pool."""
+        now = time.time()
+        spares = {}
+        for name in self.driver.list_images():
+            if not name.startswith(self.SPARE_PREFIX):
+                continue
+            parsed = self._parse_spare_name(name)
+            if parsed is None:
+                continue
+            created_at, size = parsed
+            if now - created_at > self.ttl:
+                self._remove_spare(name)
+                continue
+            try:
+                parent = tuple(self.driver.parent_info(name))
+            except self.driver.rbd.Error:
+                continue
+            spares.setdefault((parent, size), []).append((created_at, name))
+        with self._lock:
+            for key, entries in spares.items():
+                known = set(self._spares.get(key, []))
+                known.update(entries)
+                self._spares[key] = sorted(known)
+        LOG.debug('warm pool found %d spare rbd images',
+                  sum(len(entries) for entries in spares.values()))
+
+    def _prune_parents(self):
+        """Forget parents whose snapshot is gone or no longer protected."""
+        with self._lock:
+            parents = set(key[0] for key in self._spares)
+            parents.update(key[0] for key in self._hits)
+        for parent in parents:
+            pool, image, snapshot = parent
+            try:
+                if self.driver.snapshot_protected(image, snapshot, pool=pool):
+                    continue
+            except (self.driver.rbd.Error, self.driver.rados.Error,
+                    RBDOperationRejected) as e:
+                LOG.warn(_('Unable to check snapshot %(pool)s/%(img)s@'
+                           '%(snap)s: %(err)s'),
+                         {'pool': pool, 'img': image, 'snap': snapshot,
+                          'err': e})
+                continue
+            with self._lock:
+                names = []
+                for key in [k for k in self._spares if k[0] == parent]:
+                    names.extend(name for _created, name
+                                 in self._spares.pop(key))
+                for key in [k for k in self._hits if k[0] == parent]:
+                    del self._hits[key]
+            LOG.debug('dropping %(count)d spare rbd images of removed '
+                      'snapshot %(pool)s/%(img)s@%(snap)s',
+                      {'count': len(names), 'pool': pool, 'img': image,
+                       'snap': snapshot})
+            for name in names:
+                self._remove_spare(name)
+
+    def _is_popular(self, key, now):
+        hits = self._hits.get(key)
+        while hits and now - hits[0] > self.ttl:
+            hits.popleft()
+        return bool(hits) and len(hits) >= self.min_hits
+
+    def _expire(self, now):
+        with self._lock:
+            expired, self._expired = self._expired, []
+            for key, entries in self._spares.items():
+                keep = [e for e in entries if now - e[0] <= self.ttl]
+                expired.extend(e[1] for e in entries if now - e[0] > self.ttl)
+                self._spares[key] = keep
+        for name in expired:
+            self._remove_spare(name)
+
+    def _next_refill(self, now):
+        with self._lock:
+            return self._next_refill_locked(now)
+
+    def _next_refill_locked(self, now):
+        total = sum(len(entries) for entries in self._spares.values())
+        if self.max_spares and total >= self.max_spares:
+            return None
+        for key in list(self._hits):
+            if not self._is_popular(key, now):
+                if not self._hits[key]:
+                    del self._hits[key]
+                continue
+            if len(self._spares.get(key, [])) < self.spares_per_image:
+                return key
+        return None
+
+    def _create_spare(self, key):
+        (pool, image, snapshot), size = key
+        name = self._spare_name(size)
+        try:
+            self.driver._clone(pool, image, snapshot, name,
+                               priority=PRIORITY_BULK)
+            # a clone starts at the parent's size; only ever grow it
+            if size and size > self.driver.size(name):
+                self.driver.resize(name, size, priority=PRIORITY_BULK)
+        except Exception as e:
+            LOG.warn(_('Unable to create spare rbd image for '
+                       '%(pool)s/%(img)s@%(snap)s: %(err)s'),
+                     {'pool': pool, 'img': image, 'snap': snapshot,
+                      'err': e})
+            self._remove_spare(name)
+            return False
+        with self._lock:
+            self._spares.setdefault(key, []).append((time.time(), name))
+        return True
+
+    def _run(self, reconcile=False):
+        done = False
+        try:
+            if reconcile:
+                self.reconcile()
+            while not done:
+                now = time.time()
+                self._expire(now)
+                self._prune_parents()
+                key = self._next_refill(now)
+                while key is not None and self._create_spare(key):
+                    key = self._next_refill(time.time())
+                with self._lock:
+                    # a take() since the last check left its refill to us,
+                    # so look again before letting the next take() start
+                    # one; after a failed clone stop, the next take() retries
+                    if (key is not None or
+                            (not self._expired and
+                             self._next_refill_locked(time.time()) is None)):
+                        self._refilling = False
+                        done = True
+        finally:
+            if not done:
+                with self._lock:
+                    self._refilling = False
+
+    def refill(self):
+        """Start a background refill unless one is already running."""
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+        self._spawn(self._run)
+
+    def take(self, parent, size, dest_name):
+        """Rename a spare of parent at size to dest_name.
+
+        Returns True if a spare was used, False if the caller has to clone
+        dest_name itself. Either way a refill is started in the background.
+        """
+        key = (tuple(parent), size or 0)
+        now = time.time()
+        with self._lock:
+            self._hits.setdefault(key, collections.deque()).append(now)
+        try:
+            while True:
+                with self._lock:
+                    entries = self._spares.get(key)
+                    if not entries:
+                        return False
+                    entry = entries.pop(0)
+                    if now - entry[0] > self.ttl:
+                        self._expired.append(entry[1])
+                        continue
+                try:
+                    self.driver.rename(entry[1], dest_name)
+                except self.driver.rbd.ImageNotFound:
+                    # removed behind our back, try the next one
+                    continue
+                except (self.driver.rbd.Error, self.driver.rados.Error,
+                        RBDOperationRejected) as e:
+                    LOG.warn(_('Unable to use spare rbd image %(name)s for '
+                               '%(dest)s, cloning instead: %(err)s'),
+                             {'name': entry[1], 'dest': dest_name, 'err': e})
+                    with self._lock:
+                        self._spares.setdefault(key, []).insert(0, entry)
+                    return False
+                LOG.debug('provisioned %(dest)s from spare %(spare)s',
+                          {'dest': dest_name, 'spare': entry[1]})
+                return True
+        finally:
+            self.refill()
+
 
 class RBDVolumeProxy(object):
     """Context manager for dealing with an existing rbd volume.
@@ -46,9 +854,12 @@ class RBDVolumeProxy(object):
         client, ioctx = driver._connect_to_rados(pool)
         try:
             snap_name = snapshot.encode('utf8') if snapshot else None
-            self.volume = driver.rbd.Image(ioctx, name.encode('utf8'),
-                                           snapshot=snap_name,
-                                           read_only=read_only)
+            # NOTE: opening reads the image header from an OSD, so run it
+            # in a native thread rather than blocking the eventlet hub
+            self.volume = tpool.execute(driver.rbd.Image, ioctx,
+                                        name.encode('utf8'),
+                                        snapshot=snap_name,
+                                        read_only=read_only)
         except driver.rbd.ImageNotFound:
             #with excutils.save_and_reraise_exception():
                 LOG.debug("rbd image %s does not exist", name)
@@ -71,7 +882,7 @@ class RBDVolumeProxy(object):
     def __exit__(self, type_, value, traceback):
         print("*L*  RBDVolumeProxy __exit__")
         try:
-            self.volume.close()
+            tpool.execute(self.volume.close)
         finally:
             self.driver._disconnect_from_rados(self.client, self.ioctx)
 
@@ -96,14 +907,28 @@ class RADOSClient(object):
 class RBDDriver(object):
 
     def __init__(self, pool, ceph_conf, rbd_user,
-                 rbd_lib=None, rados_lib=None):
+                 rbd_lib=None, rados_lib=None, scheduler=None):
         self.pool = pool.encode('utf8')
         # NOTE(angdraug): rados.Rados fails to connect if ceph_conf is None:
         # https://github.com/ceph/ceph/pull/1787
         self.ceph_conf = ceph_conf.encode('utf8') if ceph_conf else ''
         self.rbd_user = rbd_user.encode('utf8') if rbd_user else None
+        if rbd_lib is None or rados_lib is None:
+            _load_rbd_libs()
         self.rbd = rbd_lib or rbd
         self.rados = rados_lib or rados
+        self.scheduler = scheduler or get_scheduler()
+        self.latency_guard = LatencyGuard(
+            timeout=CONF.libvirt.rbd_metadata_op_timeout,
+            hedge=CONF.libvirt.rbd_hedge_metadata_ops,
+            hedge_percentile=CONF.libvirt.rbd_hedge_percentile,
+            hedge_min_samples=CONF.libvirt.rbd_hedge_min_samples,
+            max_inflight=CONF.libvirt.rbd_metadata_max_inflight)
+        # NOTE: one connected librados client per driver, shared by all
+        # operations; only the per-pool ioctx is opened for each call.
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._fsid = None
         
         print("RBDDriver pool:%s" % self.pool)
         print("RBDDriver user:%s" % self.rbd_user)
@@ -112,27 +937,70 @@ class RBDDriver(object):
         if self.rbd is None:
             raise RuntimeError(_('rbd python libraries not found'))
 
+        self.warm_pool = None
+        if CONF.libvirt.rbd_warm_pool_size and self.supports_layering():
+            self.warm_pool = WarmPool(
+                self, CONF.host, CONF.libvirt.rbd_warm_pool_size,
+                max_spares=CONF.libvirt.rbd_warm_pool_max_spares,
+                min_hits=CONF.libvirt.rbd_warm_pool_min_hits,
+                ttl=CONF.libvirt.rbd_warm_pool_ttl)
+            self.warm_pool.start()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    client = self.rados.Rados(rados_id=self.rbd_user,
+                                              conffile=self.ceph_conf)
+                    timeout = CONF.libvirt.rbd_rados_op_timeout
+                    if timeout:
+                        client.conf_set('rados_osd_op_timeout', str(timeout))
+                        client.conf_set('rados_mon_op_timeout', str(timeout))
+                    try:
+                        tpool.execute(client.connect)
+                    except self.rados.Error:
+                        # shutdown cannot raise an exception
+                        client.shutdown()
+                        raise
+                    self._client = client
+        return self._client
+
     def _connect_to_rados(self, pool=None):
-        client = self.rados.Rados(rados_id=self.rbd_user,
-                                  conffile=self.ceph_conf)
-        try:
-            client.connect()
-            pool_to_open = pool or self.pool
-            ioctx = client.open_ioctx(pool_to_open.encode('utf-8'))
-            return client, ioctx
-        except self.rados.Error:
-            # shutdown cannot raise an exception
-            client.shutdown()
-            raise
+        client = self._get_client()
+        pool_to_open = pool or self.pool
+        ioctx = tpool.execute(client.open_ioctx,
+                              pool_to_open.encode('utf-8'))
+        return client, ioctx
 
     def _disconnect_from_rados(self, client, ioctx):
-        # closing an ioctx cannot raise an exception
+        # closing an ioctx cannot raise an exception; the client stays
+        # connected for the next operation and is shut down by close()
         ioctx.close()
-        client.shutdown()
+
+    def close(self):
+        """Shut down the driver's librados connection, if any."""
+        with self._client_lock:
+            if self._client is not None:
+                self._client.shutdown()
+                self._client = None
+
+    def _schedule(self, op_class, pool=None, priority=None):
+        return self.scheduler.schedule(pool or self.pool, op_class,
+                                       priority=priority)
 
     def supports_layering(self):
         return hasattr(self.rbd, 'RBD_FEATURE_LAYERING')
 
+    def supports_content_index(self):
+        # omap read/write operations only appeared in later python-rados
+        # bindings; without them there is nowhere to keep the dedup index
+        ioctx_class = getattr(self.rados, 'Ioctx', None)
+        return (hasattr(self.rados, 'ReadOpCtx') and
+                hasattr(self.rados, 'WriteOpCtx') and
+                all(hasattr(ioctx_class, attr) for attr in
+                    ('get_omap_vals_by_keys', 'operate_read_op',
+                     'set_omap', 'operate_write_op')))
+
     def ceph_args(self):
         args = []
         if self.rbd_user:
@@ -141,6 +1009,7 @@ class RBDDriver(object):
             args.extend(['--conf', self.ceph_conf])
         return args
 
+    @_guarded
     def get_mon_addrs(self):
         args = ['ceph', 'mon', 'dump', '--format=json'] + self.ceph_args()
         out, _ = utils.execute(*args)
@@ -173,6 +1042,13 @@ class RBDDriver(object):
         return pieces
 
     def _get_fsid(self):
+        # the fsid of a cluster never changes, so look it up only once
+        if self._fsid is None:
+            self._fsid = self._fetch_fsid()
+        return self._fsid
+
+    @_guarded
+    def _fetch_fsid(self):
         with RADOSClient(self) as client:
             return client.cluster.get_fsid()
 
@@ -204,29 +1080,153 @@ class RBDDriver(object):
                       dict(loc=url, err=e))
             return False
 
-    def clone(self, image_location, dest_name):
+    def clone(self, image_location, dest_name, size=None):
+        """Clone the rbd snapshot at image_location into dest_name.
+
+        :size: disk size in bytes the clone will be resized to, used to
+               pick a matching spare from the warm pool
+        """
         _fsid, pool, image, snapshot = self.parse_url(
                 image_location['url'])
         LOG.debug(_('cloning %(pool)s/%(img)s@%(snap)s') %
                   dict(pool=pool, img=image, snap=snapshot))
-        with RADOSClient(self, str(pool)) as src_client:
-            with RADOSClient(self) as dest_client:
-                self.rbd.RBD().clone(src_client.ioctx,
-                                     image.encode('utf-8'),
-                                     snapshot.encode('utf-8'),
-                                     dest_client.ioctx,
-                                     dest_name,
-                                     features=self.rbd.RBD_FEATURE_LAYERING)
+        self._clone_or_take(str(pool), image, snapshot, dest_name, size)
+
+    def _clone_or_take(self, pool, image, snapshot, dest_name, size):
+        if (self.warm_pool and
+                self.warm_pool.take((pool, image, snapshot), size,
+                                    dest_name)):
+            return
+        self._clone(pool, image, snapshot, dest_name)
+
+    def _clone(self, pool, image, snapshot, dest_name, priority=None):
+        with self._schedule('clone', priority=priority):
+            with RADOSClient(self, pool) as src_client:
+                with RADOSClient(self) as dest_client:
+                    self.rbd.RBD().clone(
+                        src_client.ioctx,
+                        image.encode('utf-8'),
+                        snapshot.encode('utf-8'),
+                        dest_client.ioctx,
+                        dest_name,
+                        features=self.rbd.RBD_FEATURE_LAYERING)
+
+    def import_image(self, base, name):
+        """Import a local file as a new rbd image in the driver's pool."""
+        # keep using the command line import instead of librbd since it
+        # detects zeroes to preserve sparseness in the image
+        args = ['--pool', self.pool, base, name]
+        if self.supports_layering():
+            args += ['--new-format']
+        args += self.ceph_args()
+        with self._schedule('import'):
+            utils.execute('rbd', 'import', *args)
+
+    def find_content(self, digest):
+        """Return the (image, snapshot) holding content digest, or None."""
+        with self._schedule('metadata'):
+            with RADOSClient(self) as client:
+                with self.rados.ReadOpCtx() as op:
+                    vals, _ret = client.ioctx.get_omap_vals_by_keys(
+                        op, (digest,))
+                    try:
+                        client.ioctx.operate_read_op(op,
+                                                     CONTENT_INDEX_OBJECT)
+                    except self.rados.ObjectNotFound:
+                        return None
+                    location = dict(vals).get(digest)
+        if not location:
+            return None
+        image, snapshot = location.split('@', 1)
+        if not self.exists(image, snapshot=snapshot):
+            LOG.debug('stale content index entry %(digest)s -> %(loc)s',
+                      {'digest': digest, 'loc': location})
+            return None
+        return image, snapshot
+
+    def _register_content(self, digest, image, snapshot):
+        with self._schedule('metadata'):
+            with RADOSClient(self) as client:
+                with self.rados.WriteOpCtx() as op:
+                    client.ioctx.set_omap(op, (digest,),
+                                          ('%s@%s' % (image, snapshot),))
+                    client.ioctx.operate_write_op(op, CONTENT_INDEX_OBJECT)
+
+    def _remove_content_image(self, name):
+        with self._schedule('delete'):
+            with RBDVolumeProxy(self, name) as vol:
+                vol.unprotect_snap(CONTENT_SNAPSHOT)
+                vol.remove_snap(CONTENT_SNAPSHOT)
+            with RADOSClient(self) as client:
+                self.rbd.RBD().remove(client.ioctx, name)
+
+    def import_content(self, base, digest):
+        """Import base as the shared parent image for content digest.
+
+        The file is imported under a temporary name, snapshotted and
+        protected, then renamed into place so that concurrent importers
+        of the same content end up sharing whichever parent won the
+        rename. Returns the (image, snapshot) of the parent.
+        """
+        image = CONTENT_IMAGE_PREFIX + digest
+        tmp_name = '%s.%s' % (image, uuidutils.generate_uuid())
+        self.import_image(base, tmp_name)
+        with self._schedule('metadata'):
+            with RBDVolumeProxy(self, tmp_name) as vol:
+                vol.create_snap(CONTENT_SNAPSHOT)
+                vol.protect_snap(CONTENT_SNAPSHOT)
+            try:
+                with RADOSClient(self) as client:
+                    self.rbd.RBD().rename(client.ioctx, tmp_name, image)
+                renamed = True
+            except self.rbd.ImageExists:
+                renamed = False
+        if not renamed:
+            LOG.debug('content %s was imported concurrently', digest)
+            self._remove_content_image(tmp_name)
+            if not self.exists(image, snapshot=CONTENT_SNAPSHOT):
+                raise exception.NovaException(
+                    _('rbd image %s exists without its base snapshot')
+                    % image)
+        self._register_content(digest, image, CONTENT_SNAPSHOT)
+        return image, CONTENT_SNAPSHOT
 
+    def import_image_dedup(self, base, name, size=None):
+        """Create name from base, sharing storage with identical content.
+
+        If an image with the same content is already in the pool, name is
+        cloned from it and nothing is imported.
+        """
+        # NOTE: the digest is needed before anything is imported, since
+        # the whole point is to skip the import when the content is
+        # already in the pool. Hashing while streaming into 'rbd import -'
+        # would only learn the digest after paying for the import. So on
+        # a miss the base is read twice: once locally to hash it, where
+        # the second read is usually served from the page cache, and once
+        # by 'rbd import'. The digest is cached per base file, so later
+        # spawns from the same base do not hash it again.
+        # hashing a multi-GB base is CPU bound, keep it off the hub
+        digest = tpool.execute(file_digest, base)
+        parent = self.find_content(digest)
+        if parent is None:
+            parent = self.import_content(base, digest)
+        else:
+            LOG.debug('%(base)s already stored as %(img)s@%(snap)s',
+                      {'base': base, 'img': parent[0], 'snap': parent[1]})
+        self._clone_or_take(self.pool, parent[0], parent[1], name, size)
+
+    @_guarded
     def size(self, name):
         with RBDVolumeProxy(self, name) as vol:
             return vol.size()
 
-    def resize(self, name, size_bytes):
+    def resize(self, name, size_bytes, priority=None):
         LOG.debug('resizing rbd image %s to %d', name, size_bytes)
-        with RBDVolumeProxy(self, name) as vol:
-            vol.resize(size_bytes)
+        with self._schedule('resize', priority=priority):
+            with RBDVolumeProxy(self, name) as vol:
+                vol.resize(size_bytes)
 
+    @_guarded
     def exists(self, name, pool=None, snapshot=None):
         # traceback.print_stack(file=sys.stderr)
         try:
@@ -238,24 +1238,58 @@ class RBDDriver(object):
         except self.rbd.ImageNotFound:
             return False
 
+    def parent_info(self, name):
+        with self._schedule('metadata', priority=PRIORITY_BULK):
+            with RBDVolumeProxy(self, name, read_only=True) as vol:
+                return vol.parent_info()
+
+    def snapshot_protected(self, name, snapshot, pool=None):
+        """Return whether snapshot of name exists and is protected."""
+        with self._schedule('metadata', pool=pool, priority=PRIORITY_BULK):
+            try:
+                with RBDVolumeProxy(self, name, pool=pool,
+                                    read_only=True) as vol:
+                    return vol.is_protected_snap(snapshot.encode('utf-8'))
+            except self.rbd.ImageNotFound:
+                return False
+
+    def list_images(self):
+        with self._schedule('metadata', priority=PRIORITY_BULK):
+            with RADOSClient(self) as client:
+                return self.rbd.RBD().list(client.ioctx)
+
+    def rename(self, src_name, dest_name):
+        with self._schedule('metadata'):
+            with RADOSClient(self) as client:
+                self.rbd.RBD().rename(client.ioctx, src_name, dest_name)
+
+    def remove(self, name):
+        with self._schedule('delete'):
+            with RADOSClient(self) as client:
+                self.rbd.RBD().remove(client.ioctx, name)
+
     def cleanup_volumes(self, instance):
         with RADOSClient(self, self.pool) as client:
 
             def belongs_to_instance(disk):
                 return disk.startswith(instance['uuid'])
 
-            volumes = self.rbd.RBD().list(client.ioctx)
+            with self._schedule('metadata', priority=PRIORITY_BULK):
+                volumes = self.rbd.RBD().list(client.ioctx)
             for volume in filter(belongs_to_instance, volumes):
                 try:
-                    self.rbd.RBD().remove(client.ioctx, volume)
-                except (rbd.ImageNotFound, rbd.ImageHasSnapshots):
+                    with self._schedule('delete'):
+                        self.rbd.RBD().remove(client.ioctx, volume)
+                except (self.rbd.ImageNotFound,
+                        self.rbd.ImageHasSnapshots):
                     LOG.warn(_('rbd remove %(volume)s in pool %(pool)s '
                                'failed'),
                              {'volume': volume, 'pool': self.pool})
 
+    @_guarded
     def get_pool_info(self):
         with RADOSClient(self) as client:
-            stats = client.cluster.get_cluster_stats()
+            stats = tpool.execute(client.cluster.get_cluster_stats)
             return {'total': stats['kb'] * units.Ki,
-                    'free':  stats['kb_avail'] * units.Ki,
-                    'used':  stats['kb_used'] * units.Ki}
+                    'free': stats['kb_avail'] * units.Ki,
+                    'used': stats['kb_used'] * units.Ki}